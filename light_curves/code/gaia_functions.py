@@ -1,16 +1,32 @@
+import cProfile
+import os
+import pstats
+import tempfile
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import astropy.units as u
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
+from astropy.coordinates import ICRS, SkyCoord
 from astropy.table import Table, hstack, vstack
 from astropy.time import Time
+from astropy_healpix import HEALPix
 from astroquery.gaia import Gaia
 from tqdm import tqdm
 
 from data_structures import MultiIndexDFObject
 
+## Constants for converting between magnitudes and fluxes
+LN10 = np.log(10.0)
+MAGERR_K = 2.5 / LN10 # converts a relative flux error into a magnitude error
+FLUX_EXP_K = -0.4 * LN10 # 10**(-0.4*x) = exp(FLUX_EXP_K*x)
+
+## Time (MJD) used for the mean photometry of sources without Gaia epoch photometry.
+# just random date: FIXME: NEED TO GET ACTUAL OBSERVATION TIME!
+GAIA_MEAN_EPOCH_MJD = Time("2015-09-24T19:40:33.468" , format="isot").mjd
+
 
 def Gaia_get_lightcurve(coords_list, labels_list , verbose):
     '''
@@ -74,6 +90,47 @@ def Gaia_get_lightcurve(coords_list, labels_list , verbose):
     return(df_lc)
 
 
+def Gaia_profile_lightcurve(coords_list, labels_list , verbose , nbr_lines=20 , output_file=None):
+    '''
+    Runs `Gaia_get_lightcurve()` under the Python profiler (cProfile) and prints the functions
+    that take the most time. This is meant to check where the time is spent (e.g., waiting for
+    the Gaia server vs. building the tables), not as a benchmark.
+    
+    Parameters
+    ----------
+    coords_list : list of Astropy SkyCoord objects
+        List of (id,coordinates) tuples of the sources
+    
+    labels_list : list of str
+        List of labels for each soruce
+        
+    verbose : int
+        How much to talk. 0 = None, 1 = a little bit , 2 = more, 3 = full
+
+    nbr_lines : int
+        Number of functions to print, sorted by cumulative time.
+
+    output_file : str or None
+        If given, the profile is saved to this file (e.g., to look at it with `snakeviz output_file`).
+    
+    
+    Returns
+    --------
+    MultiIndexDFObject returned by `Gaia_get_lightcurve()`.
+    
+    '''
+
+    profiler = cProfile.Profile()
+    df_lc = profiler.runcall(Gaia_get_lightcurve, coords_list, labels_list, verbose)
+
+    stats = pstats.Stats(profiler)
+    stats.sort_stats("cumulative").print_stats(nbr_lines)
+    if output_file is not None:
+        stats.dump_stats(output_file)
+
+    return(df_lc)
+
+
 def Gaia_extract_median_photometry(gaia_table):
     '''
     Extract the median photometry from a Gaia table produced by `Gaia_retrieve_median_photometry`.
@@ -107,11 +164,13 @@ def Gaia_extract_median_photometry(gaia_table):
     ## Get photometry. Note that this includes only objects that are 
     # matched to the catalog. We have to add the missing ones later.
     _phot = gaia_table[mag_keys]
-    _err = hstack( [ 2.5/np.log(10) * gaia_table[e]/gaia_table[f] for e,f in zip(fluxerr_keys,flux_keys) ] )
+    # np.ma.stack keeps the masks of null (masked) fluxes, np.stack would drop them
+    _flux = np.ma.stack([gaia_table[f].data for f in flux_keys] , axis=1)
+    _fluxerr = np.ma.stack([gaia_table[e].data for e in fluxerr_keys] , axis=1)
+    _err = Table( MAGERR_K * _fluxerr / _flux , names=magerr_keys )
     gaia_phot2 = hstack( [_phot , _err] )
 
-    ## Clean up (change units and column names)
-    _ = [gaia_phot2.rename_column(f,m) for m,f in zip(magerr_keys,fluxerr_keys)]
+    ## Clean up (change units)
     for key in magerr_keys:
         gaia_phot2[key].unit = "mag"
     gaia_phot2["input_object_name"] = gaia_table["input_object_name"].copy()
@@ -143,7 +202,8 @@ def Gaia_extract_median_photometry(gaia_table):
     return(gaia_phot)
 
 
-def Gaia_retrieve_median_photometry(coords_list , labels_list , gaia_source_table , search_radius, verbose):
+def Gaia_retrieve_median_photometry(coords_list , labels_list , gaia_source_table , search_radius, verbose,
+                                    method="upload", max_workers=8, healpix_level=5):
     '''
     Retrieves the photometry table for a list of sources.
     
@@ -163,6 +223,22 @@ def Gaia_retrieve_median_photometry(coords_list , labels_list , gaia_source_tabl
         
     verbose : int
         How much to talk. 0 = None, 1 = a little bit , 2 = more, 3 = full
+
+    method : str
+        How to match the sources to the Gaia catalog. "upload" (default) uploads all sources
+        and matches them in a single query on the Gaia server (only sources within 1 arcsec,
+        the match radius, are returned). "cone" runs one cone search per source, with
+        `max_workers` searches running concurrently. "healpix" downloads the Gaia sources
+        in all HEALPix pixels that cover the sources with one query and matches them locally,
+        which is fastest for many sources in a small area of the sky.
+
+    max_workers : int
+        Number of concurrent cone searches for `method="cone"`. Keep this at about 4-16
+        to stay below the rate limit of the Gaia archive.
+
+    healpix_level : int
+        HEALPix level (nside = 2**healpix_level) of the pixels downloaded for `method="healpix"`.
+        Default is 5 (about 3.4 square degrees per pixel).
         
     Returns
     --------
@@ -178,41 +254,178 @@ def Gaia_retrieve_median_photometry(coords_list , labels_list , gaia_source_tabl
 
 
     ## Search and Cross match.
-    # This can be done in a smarter way by matching catalogs on the Gaia server, or grouping the
-    # sources and search a larger area.
-
-    # get catalog
-    gaia_table = Table()
     t1 = time.time()
-    for objectid, coord in tqdm(coords_list):
-        
-        gaia_search = Gaia.cone_search_async(coordinate=coord, radius=search_radius , background=True)
-        gaia_search.get_data()["dist"].unit = "deg"
-        gaia_search.get_data()["dist"] = gaia_search.get_data()["dist"].to(u.arcsec) # Change distance unit from degrees to arcseconds
-
-
-        # match
-        if len(gaia_search.get_data()["dist"]) > 0:
-            gaia_search.get_data()["input_object_name"] = objectid # add input object name to catalog
-            sel_min = np.where( (gaia_search.get_data()["dist"] < 1*u.arcsec) & (gaia_search.get_data()["dist"] == np.nanmin(gaia_search.get_data()["dist"]) ) )[0]
-        else:
-            sel_min = []
-
-        if len(sel_min) > 0:
-            gaia_table = vstack( [gaia_table , gaia_search.get_data()[sel_min]] )
-        else:
-            gaia_table = vstack( [gaia_table , gaia_search.get_data()[sel_min]] )
+    if method == "upload":
+        # All sources are uploaded to the Gaia server as a table and matched to the Gaia
+        # catalog in a single query, instead of running one cone search per source.
+        # Only Gaia sources within the match radius can be kept, so we only ask for those
+        # and let the server sort them by distance.
+        match_radius = u.Quantity(1,u.arcsec)
+        upload_table = Table([[objectid for objectid, _ in coords_list],
+                              [coord.ra.deg for _, coord in coords_list],
+                              [coord.dec.deg for _, coord in coords_list]],
+                             names=["input_object_name","ra","dec"])
+
+        query = """
+        SELECT u.input_object_name, g.*,
+               DISTANCE(POINT('ICRS', u.ra, u.dec), POINT('ICRS', g.ra, g.dec)) AS dist
+        FROM tap_upload.input_sources AS u
+        JOIN {table} AS g
+        ON 1=CONTAINS(POINT('ICRS', u.ra, u.dec), CIRCLE('ICRS', g.ra, g.dec, {radius}))
+        ORDER BY u.input_object_name ASC, dist ASC
+        """.format(table=gaia_source_table , radius=min(search_radius,match_radius).to(u.deg).value)
+
+        # get catalog
+        gaia_job = Gaia.launch_job_async(query=query, upload_resource=upload_table,
+                                         upload_table_name="input_sources", verbose=False)
+        gaia_table = gaia_job.get_results()
+        gaia_table["dist"].unit = "deg"
+        gaia_table["dist"] = gaia_table["dist"].to(u.arcsec) # Change distance unit from degrees to arcseconds
+
+        # match: keep the closest Gaia source for each input source (first row since sorted by distance).
+        _, sel_first = np.unique(np.asarray(gaia_table["input_object_name"]) , return_index=True)
+        gaia_table = gaia_table[sel_first]
+        gaia_table = gaia_table[gaia_table["dist"] < match_radius]
+
+    elif method == "cone":
+        # The cone searches only wait for the Gaia server, so we run them concurrently.
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(Gaia_cone_search_nearest, objectid, coord, search_radius)
+                       for objectid, coord in coords_list]
+            matches = [future.result() for future in tqdm(futures)]
+
+        # get catalog (empty matches are stacked as well so that the columns are kept if nothing matches)
+        gaia_table = vstack(matches)
+
+    elif method == "healpix":
+        gaia_table = Gaia_healpix_crossmatch(coords_list, gaia_source_table, healpix_level=healpix_level, verbose=verbose)
+
+    else:
+        raise ValueError("Unknown method '{}'. Use 'upload', 'cone', or 'healpix'.".format(method))
 
     if verbose > 0: print("\nSearch completed in {:.2f} seconds".format((time.time()-t1) ) )
     if verbose > 0: print("Number of objects matched: {} out of {}.".format(len(gaia_table),len(coords_list) ) )
     
     return(gaia_table)
     
+
+def Gaia_healpix_crossmatch(coords_list, gaia_source_table, healpix_level, verbose):
+    '''
+    Matches a list of sources to the Gaia catalog locally. All Gaia sources in the HEALPix
+    pixels covering the sources are downloaded in one query, and each source is matched to
+    its closest Gaia source using a KD-tree.
     
+    Parameter
+    ----------
+    coords_list : list of Astropy SkyCoord objects
+        List of (id,coordinates) tuples of the sources
+        
+    gaia_source_table : str
+        Gaia source table, e.g., "gaiaedr3.gaia_source"
+        
+    healpix_level : int
+        HEALPix level (nside = 2**healpix_level) of the downloaded pixels
+        
+    verbose : int
+        How much to talk. 0 = None, 1 = a little bit , 2 = more, 3 = full
+        
+    Returns
+    --------
+    Astropy table with the closest Gaia source within 1 arcsec for each matched source.
+    
+    '''
+    
+    match_radius = u.Quantity(1,u.arcsec)
+    coords = SkyCoord([coord for _, coord in coords_list])
+
+    ## Find HEALPix pixels (nested) covering all sources
+    hp = HEALPix(nside=2**healpix_level, order="nested", frame=ICRS())
+    pix = hp.skycoord_to_healpix(coords)
+
+    # Sources closer than the match radius to a pixel edge also need the neighboring pixels. We find
+    # them by checking 8 positions around each source (at a distance such that the octagon through
+    # them encloses the match radius) for a different pixel.
+    offset = match_radius / np.cos(np.pi/8)
+    near_edge = np.zeros(len(coords), dtype=bool)
+    for position_angle in np.arange(0, 360, 45)*u.deg:
+        near_edge |= hp.skycoord_to_healpix(coords.directional_offset_by(position_angle, offset)) != pix
+    neighbours = hp.neighbours(pix[near_edge]).ravel()
+    pixels = np.unique(np.concatenate([pix, neighbours[neighbours >= 0]]))
+    if verbose > 1: print("Number of HEALPix pixels to download: {}".format(len(pixels)))
+
+    ## The Gaia source_id encodes the level 12 HEALPix pixel (source_id // 2**35), so a pixel
+    # on a coarser level is a range of source_id. Merge neighboring pixels into a single range.
+    id_step = 2**35 * 4**(12 - healpix_level)
+    breaks = np.where(np.diff(pixels) > 1)[0]
+    range_start = pixels[np.concatenate([[0], breaks + 1])]
+    range_end = pixels[np.concatenate([breaks, [len(pixels) - 1]])]
+    where = " OR ".join(["source_id BETWEEN {} AND {}".format(int(start) * id_step, (int(end) + 1) * id_step - 1)
+                         for start, end in zip(range_start, range_end)])
+
+    ## Download all Gaia sources in these pixels (only the columns we need later)
+    columns = ["source_id","ra","dec"] + ["phot_{}_{}".format(band,key) for band in ["g","bp","rp"]
+                                          for key in ["mean_mag","mean_flux","mean_flux_error","n_obs"]]
+    query = "SELECT {} FROM {} WHERE {}".format(", ".join(columns), gaia_source_table, where)
+    gaia_job = Gaia.launch_job_async(query=query, verbose=False)
+    gaia_cat = gaia_job.get_results()
+    if verbose > 1: print("Number of Gaia sources downloaded: {}".format(len(gaia_cat)))
+
+    ## Match locally (KD-tree)
+    if len(gaia_cat) > 0:
+        gaia_coords = SkyCoord(ra=np.asarray(gaia_cat["ra"]), dec=np.asarray(gaia_cat["dec"]), unit="deg")
+        idx, sep, _ = coords.match_to_catalog_sky(gaia_coords)
+        sel = np.where(sep < match_radius)[0]
+    else: # nothing downloaded: no matches, but keep the columns
+        idx, sep, sel = np.array([], dtype=int), u.Quantity([], u.deg), np.array([], dtype=int)
+
+    object_names = np.asarray([objectid for objectid, _ in coords_list])
+    gaia_table = gaia_cat[idx[sel]]
+    gaia_table.add_column(object_names[sel], name="input_object_name", index=0)
+    gaia_table["dist"] = sep[sel].to(u.arcsec)
+
+    return(gaia_table)
+
+
+def Gaia_cone_search_nearest(objectid, coord, search_radius):
+    '''
+    Runs a Gaia cone search around one source and returns the closest match.
+    
+    Parameter
+    ----------
+    objectid : int
+        ID of the source, saved as `input_object_name` in the output table
+    
+    coord : Astropy SkyCoord object
+        Coordinates of the source
+        
+    search_radius : float (as astropy Quantity with unit u.arcsec)
+        Search radius in arcseconds, e.g., 20*u.arcsec
+        
+    Returns
+    --------
+    Astropy table with the closest Gaia source within 1 arcsec (or an empty table if there is none).
+    
+    '''
+    
+    gaia_search = Gaia.cone_search_async(coordinate=coord, radius=search_radius , background=True)
+    data = gaia_search.get_data()
+    data["dist"].unit = "deg"
+    data["dist"] = data["dist"].to(u.arcsec) # Change distance unit from degrees to arcseconds
+
+    # match
+    data["input_object_name"] = objectid # add input object name to catalog
+    if len(data) > 0:
+        dist = data["dist"].quantity
+        ii = np.nanargmin(dist.value) # closest source
+        sel_min = [ii] if dist[ii] < 1*u.arcsec else []
+    else:
+        sel_min = []
+
+    return(data[sel_min])
 
 
 ## Define function to retrieve epoch photometry
-def Gaia_retrieve_EPOCH_PHOTOMETRY(ids, verbose):
+def Gaia_retrieve_EPOCH_PHOTOMETRY(ids, verbose, chunk_size=50, max_workers=4):
     """
     Function to retrieve EPOCH_PHOTOMETRY (or actually any) catalog product for Gaia
     entries using the DataLink. Note that the IDs need to be DR3 source_id and needs to be a list.
@@ -226,10 +439,17 @@ def Gaia_retrieve_EPOCH_PHOTOMETRY(ids, verbose):
         
     verbose : int
         How much to talk. 0 = None, 1 = a little bit , 2 = more, 3 = full
+
+    chunk_size : int
+        Number of source IDs requested from the DataLink service at once.
+
+    max_workers : int
+        Number of chunks that are downloaded concurrently.
     
     Returns
     --------
-    Returns a dictionary (key = source_id) with a table of photometry as a function of time.
+    Returns a dictionary (key = source_id) with the photometry as a function of time. Each entry is a
+        dictionary of numpy arrays with the keys "band", "rejected_by_photometry", "time", "mag", "flux", and "flux_error".
         
     """
     
@@ -242,10 +462,25 @@ def Gaia_retrieve_EPOCH_PHOTOMETRY(ids, verbose):
     data_release   = 'Gaia DR3'     # Options are: 'Gaia DR3' (default), 'Gaia DR2'
 
     ## Get the files
-    datalink = Gaia.load_data(ids=ids,
-                              data_release = data_release,
-                              retrieval_type=retrieval_type,
-                              data_structure = data_structure, verbose = False, output_file = None , overwrite_output_file=True)
+    # The IDs are split in chunks that are downloaded concurrently. On astroquery 0.4.6/0.4.7,
+    # `Gaia.load_data()` extracts the download into the directory of `output_file` and reads every
+    # file in it, and its default directory name only changes once per second. Therefore, each
+    # chunk gets its own (not yet existing) subdirectory of a temporary directory, which
+    # `Gaia.load_data()` creates. Newer astroquery versions ignore `output_file` and already use
+    # a separate temporary directory for each call.
+    chunks = [ids[ii:ii+chunk_size] for ii in range(0, len(ids), chunk_size)]
+    datalink = dict()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(Gaia.load_data, ids=chunk,
+                                       data_release = data_release,
+                                       retrieval_type=retrieval_type,
+                                       data_structure = data_structure, verbose = False,
+                                       output_file = os.path.join(tmpdir, str(cc), "datalink_output.zip"),
+                                       overwrite_output_file=True)
+                       for cc, chunk in enumerate(chunks)]
+            for future in futures:
+                datalink.update(future.result())
     dl_keys  = list(datalink.keys())
     
     if verbose > 2:
@@ -254,12 +489,16 @@ def Gaia_retrieve_EPOCH_PHOTOMETRY(ids, verbose):
             print(f' * {dl_key}')
     
     ## Extract the info
+    # Only a few columns are used later, so we read them directly from the VOTable array
+    # instead of converting the full VOTable into an Astropy table.
+    columns = ["band","rejected_by_photometry","time","mag","flux","flux_error"]
     prod_tab = dict() # Dictionary to save the light curves. The key is the source_id
     for dd in ids:
         if verbose > 2: print("{}: ".format(dd) , end=" ")
         this_dl_key = 'EPOCH_PHOTOMETRY-Gaia DR3 {}.xml'.format(dd)
         if this_dl_key in datalink.keys():
-            prod_tab[str(dd)] = datalink[this_dl_key][0].to_table()
+            arr = datalink[this_dl_key][0].array
+            prod_tab[str(dd)] = {name: arr[name] for name in columns}
             if verbose > 2: print("found")
         else:
             pass
@@ -274,8 +513,8 @@ def Gaia_mk_lightcurves(prod_tab , verbose):
     
     Parameters
     ----------
-    prod_tab : astropy table
-        Product table downloaded via datalink, produced by `Gaia_retrieve_EPOCH_PHOTOMETRY()`.
+    prod_tab : dict
+        Product tables downloaded via datalink (dictionaries of numpy arrays), produced by `Gaia_retrieve_EPOCH_PHOTOMETRY()`.
         
     verbose : int
         How much to talk. 0 = None, 1 = a little bit , 2 = more, 3 = full
@@ -283,7 +522,7 @@ def Gaia_mk_lightcurves(prod_tab , verbose):
     Returns
     --------
     Returns a dictionary (key = source_id) including a dictionary of light curves for bands "G", "BP", "RP". Each
-        of them includes a time stamp (`time_jd` and `time_isot`) a magnitude (`mag`) and magnitude error (`magerr`).
+        of them includes a time stamp (`time_jd`) a magnitude (`mag`) and magnitude error (`magerr`).
     """
     
     bands = ["G","BP","RP"]
@@ -291,18 +530,27 @@ def Gaia_mk_lightcurves(prod_tab , verbose):
     for ii,key in enumerate(list(prod_tab.keys()) ):
         if verbose > 2: print(key)
     
+        # remove rejected epochs once for all bands
+        tbl = prod_tab[key]
+        keep = ~np.asarray(tbl["rejected_by_photometry"] , dtype=bool)
+        band_all = np.asarray(tbl["band"])[keep]
+        time_all = np.asarray(tbl["time"])[keep]
+        mag_all = np.asarray(tbl["mag"])[keep]
+
+        # magnitude errors for all epochs of this source at once
+        magerr_all = MAGERR_K * np.asarray(tbl["flux_error"])[keep] / np.asarray(tbl["flux"])[keep]
+
         output[str(key)] = dict()
         for band in bands:
-            sel_band = np.where( (prod_tab[key]["band"] == band) & (prod_tab[key]["rejected_by_photometry"] == False) )[0]
-            if verbose > 1: print("Number of entries for band {}: {}".format(band , len(sel_band)))
+            sel_band = (band_all == band) # boolean mask
+            if verbose > 1: print("Number of entries for band {}: {}".format(band , np.count_nonzero(sel_band)))
             
-            time_jd = prod_tab[key][sel_band]["time"] + 2455197.5 # What unit???
-            time_isot = Time(time_jd , format="jd").isot
-            mag = prod_tab[key][sel_band]["mag"]
-            magerr = 2.5/np.log(10) * prod_tab[key][sel_band]["flux_error"]/prod_tab[key][sel_band]["flux"]
+            time_jd = time_all[sel_band] + 2455197.5 # What unit???
+            mag = mag_all[sel_band]
+            magerr = magerr_all[sel_band]
             
-            output[str(key)][band] = Table([time_jd , time_isot , mag , magerr] , names=["time_jd","time_isot","mag","magerr"] ,
-                                           dtype = [float , str , float , float], units=[u.d , ""  , u.mag , u.mag])
+            output[str(key)][band] = Table([time_jd , mag , magerr] , names=["time_jd","mag","magerr"] ,
+                                           dtype = [float , float , float], units=[u.d , u.mag , u.mag])
             
     return(output)
 
@@ -337,6 +585,12 @@ def Gaia_mk_MultiIndex(coords_list, labels_list, gaia_phot , gaia_epoch_phot , v
     frame via df_lc_object.append(df_lc)
     '''
 
+    # collect the columns of all sources and build the data frame once at the end
+    objectid_col, label_col, band_col, time_col, mag_col, magerr_col = [], [], [], [], [], []
+
+    # row in gaia_phot for each matched input object name
+    idx_by_name = {name: ii for ii, name in enumerate(np.asarray(gaia_phot["input_object_name"]))}
+
     for objectid, _ in coords_list:
         #print("{} matched to: ".format( data["Object Name"][ii])  , end=" ")
 
@@ -344,90 +598,99 @@ def Gaia_mk_MultiIndex(coords_list, labels_list, gaia_phot , gaia_epoch_phot , v
 
         # get Gaia source_id
         #sel = np.where(data["Object Name"][ii] == gaia_phot["input_object_name"])[0]
-        sel = np.where(objectid == gaia_phot["input_object_name"])[0]
+        sel = idx_by_name.get(objectid)
         lab = labels_list[objectid]
         
-        if len(sel) > 0:
-            source_id = gaia_phot["source_id"][sel[0]]
+        if sel is not None:
+            source_id = gaia_phot["source_id"][sel]
             if verbose > 1: print(source_id , end=" ")
 
             if str(source_id) in gaia_epoch_phot.keys(): # Match to Gaia multi-epoch catalog
                 if verbose > 1: print("Has Gaia epoch photometry")
 
-                for band in ["G","BP","RP"]:
+                for bb, band in enumerate(["G","BP","RP"]):
 
                     # get data
-                    d = gaia_epoch_phot[str(source_id)][band]["time_isot"]
-                    t = Time(d , format="isot") # convert to time object
+                    mjd = gaia_epoch_phot[str(source_id)][band]["time_jd"] - 2400000.5 # convert JD to MJD
                     y = gaia_epoch_phot[str(source_id)][band]["mag"]
                     dy = gaia_epoch_phot[str(source_id)][band]["magerr"]
 
-                    # compute flux and flux error in mJy
-                    y2 = 10**(-0.4*(y - 23.9))/1e3 # in mJy
-                    dy2 = dy / 2.5 * np.log(10) * y2 # in mJy
-
-                    # create single instance
-                    dfsingle = pd.DataFrame(
-                                dict(flux=np.asarray(y2), # in mJy
-                                 err=np.asarray(dy2), # in mJy
-                                 time=t.mjd, # in MJD
-                                 #objectid=gaia_phot["input_object_name"][sel],
-                                 objectid=np.repeat(objectid, len(y)),label=lab,
-                                 band="Gaia {}".format(band.lower())
-                                                )
-                                           ).set_index(["objectid","label", "band", "time"])
-
-                    # add to table
-                    try:
-                        this_df_lc
-                    except NameError:
-                        #this_df_lc doesn't exist (yet)
-                        this_df_lc = dfsingle.copy()
-                    else:
-                        #this_df_lc_gaia exists
-                        this_df_lc = pd.concat([this_df_lc, dfsingle])
+                    # add to columns
+                    objectid_col.append(np.full(len(y), objectid))
+                    label_col.append(np.full(len(y), lab))
+                    band_col.append(np.full(len(y), bb, dtype=np.int8)) # index of band name
+                    time_col.append(np.asarray(mjd)) # in MJD
+                    mag_col.append(np.asarray(y))
+                    magerr_col.append(np.asarray(dy))
 
             else: # No match to Gaia multi-epoch catalog: use single epoch photometry
                 if verbose > 1: print("No Gaia epoch photometry, append single epoch photometry ")
 
-                for band in ["G","BP","RP"]:
+                for bb, band in enumerate(["G","BP","RP"]):
 
                     # get data
-                    t = Time("2015-09-24T19:40:33.468" , format="isot") # just random date: FIXME: NEED TO GET ACTUAL OBSERVATION TIME!
-                    y = gaia_phot["phot_{}_mean_mag".format(band.lower())][sel]
-                    dy = gaia_phot["phot_{}_mean_mag_error".format(band.lower())][sel]
-
-                    # compute flux and flux error in mJy
-                    y2 = 10**(-0.4*(y - 23.9))/1e3 # in mJy
-                    dy2 = dy / 2.5 * np.log(10) * y2 # in mJy
-
-                    # create single instance
-                    dfsingle = pd.DataFrame(
-                                dict(flux=np.asarray(y2), # in mJy
-                                 err=np.asarray(dy2), # in mJy
-                                 time=t.mjd, # in MJD
-                                 #objectid=gaia_phot["input_object_name"][sel],
-                                 objectid=np.repeat(objectid, len(y)),label=lab,
-                                 band="Gaia {}".format(band.lower())
-                                    )
-                    ).set_index(["objectid", "label", "band", "time"])
-
-                    # add to table
-                    try:
-                        this_df_lc
-                    except NameError:
-                        #this_df_lc doesn't exist (yet)
-                        this_df_lc = dfsingle.copy()
-                    else:
-                        #this_df_lc_gaia exists
-                        this_df_lc = pd.concat([this_df_lc, dfsingle])
+                    y = gaia_phot["phot_{}_mean_mag".format(band.lower())][[sel]]
+                    dy = gaia_phot["phot_{}_mean_mag_error".format(band.lower())][[sel]]
+
+                    # add to columns
+                    objectid_col.append(np.full(len(y), objectid))
+                    label_col.append(np.full(len(y), lab))
+                    band_col.append(np.full(len(y), bb, dtype=np.int8)) # index of band name
+                    time_col.append(np.full(len(y), GAIA_MEAN_EPOCH_MJD)) # in MJD
+                    mag_col.append(np.asarray(y))
+                    magerr_col.append(np.asarray(dy))
 
         else: # no match to Gaia
             if verbose > 1: print("none")
+
+    if len(mag_col) == 0: # no source matched to Gaia: return empty data frame
+        return(MultiIndexDFObject().data)
+
+    # compute flux and flux error in mJy for all epochs at once
+    flux, err = Gaia_mag_to_flux(np.concatenate(mag_col) , np.concatenate(magerr_col))
+
+    index = pd.MultiIndex.from_arrays([np.concatenate(objectid_col),
+                                       pd.Categorical(np.concatenate(label_col)),
+                                       pd.Categorical.from_codes(np.concatenate(band_col), categories=["Gaia g","Gaia bp","Gaia rp"]),
+                                       np.concatenate(time_col)], # in MJD
+                                      names=["objectid","label", "band", "time"])
+    this_df_lc = pd.DataFrame(dict(flux=flux, # in mJy
+                                   err=err # in mJy
+                                  ), index=index)
             
     return(this_df_lc)
 
 
+def Gaia_mag_to_flux(mag , magerr):
+    '''
+    Converts AB magnitudes and magnitude errors to flux and flux error in mJy. The
+    conversion is done in place on the output arrays to avoid temporary arrays.
+    
+    Parameter
+    ---------
+    mag : numpy array
+        AB magnitudes
+        
+    magerr : numpy array
+        Magnitude errors
+        
+    Returns
+    --------
+    Tuple of numpy arrays (flux, flux error), both in mJy.
+    
+    '''
+    
+    flux = mag - 23.9
+    flux *= FLUX_EXP_K
+    np.exp(flux , out=flux)
+    flux /= 1e3 # in mJy
+
+    err = magerr / MAGERR_K
+    err *= flux # in mJy
+
+    return(flux , err)
+
+
 def Gaia_plot_lightcurves(df_lc , nbr_objects):
     '''
     Plots the Gaia light curves for a select number of sources.
@@ -462,9 +725,8 @@ def Gaia_plot_lightcurves(df_lc , nbr_objects):
             for bb,band in enumerate(["G","BP","RP"]):
 
                 this_tab = df_lc.data.loc[dd,:,"Gaia {}".format(band.lower()),:].reset_index(inplace=False)
-                t = Time(this_tab["time"] , format="mjd") # convert to time object
-                #axs[bb].plot(t.mjd , this_tab["flux"] , "-" , linewidth=1 , markersize=0.1)
-                axs[bb].errorbar(t.mjd , this_tab["flux"] , yerr=this_tab["err"] , fmt="-o",linewidth=0.5 , markersize=3 , label="{}".format(dd))
+                #axs[bb].plot(this_tab["time"] , this_tab["flux"] , "-" , linewidth=1 , markersize=0.1)
+                axs[bb].errorbar(this_tab["time"] , this_tab["flux"] , yerr=this_tab["err"] , fmt="-o",linewidth=0.5 , markersize=3 , label="{}".format(dd))
         except:
             pass
 